@@ -1,8 +1,16 @@
 
+import glob
+import hashlib
 import json
+import multiprocessing
 import os
+import signal
+import sqlite3
+import threading
 import time
-import google.generativeai as genai
+import zlib
+import numpy as np
+import orjson
 from pinecone import Pinecone, ServerlessSpec
 from dotenv import load_dotenv
 
@@ -14,213 +22,761 @@ load_dotenv(dotenv_path=env_path, override=True)
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY", "").strip()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "").strip()
 
-print(f"DEBUG: Loaded env from {env_path}")
-print(f"DEBUG: Pinecone Key: {PINECONE_API_KEY[:10]}... (Length: {len(PINECONE_API_KEY)})" if PINECONE_API_KEY else "DEBUG: Pinecone Key: None")
-
-if not PINECONE_API_KEY:
-    print("❌ Missing PINECONE_API_KEY")
-    exit(1)
-if not GOOGLE_API_KEY:
-    print("❌ Missing GOOGLE_API_KEY")
-    exit(1)
-
 # Configuration
 INDEX_NAME = "media-knowledge-graph"
 EMBEDDING_MODEL = "models/text-embedding-004"
-BATCH_SIZE = 100
+EMBED_TASK_TYPE = "RETRIEVAL_DOCUMENT"
+EMBED_URL = f"https://generativelanguage.googleapis.com/v1beta/{EMBEDDING_MODEL}:batchEmbedContents"
 DATA_FILE = "data/full_knowledge_graph.json"
-CHECKPOINT_FILE = "data/ingestion_checkpoint.json"
-FAILED_LOG_FILE = "data/ingestion_failed.json"
+LEGACY_CHECKPOINT_FILE = "data/ingestion_checkpoint.json"  # Single-process checkpoint from before sharding
+CHECKPOINT_PATTERN = "data/ingestion_checkpoint_{rank}.json"
+FAILED_LOG_FILE = "data/ingestion_failed.jsonl"
+EMBED_CACHE_FILE = "data/embed_cache.db"  # blake2b(model, task, text) -> float32 embedding, shared by all shards
+UPSERT_POOL_THREADS = 30  # Parallel in-flight upsert requests (async_req)
+EMBED_BATCH_SIZE = 100  # Gemini batchEmbedContents accepts up to 100 texts per call
+UPSERT_BATCH_SIZE = 100  # Pinecone recommends <= 100 vectors per upsert request
+UPSERT_BYTE_BUDGET = 1_900_000  # Pinecone caps upsert requests at 2MB; keep some headroom
+CHECKPOINT_EVERY = 5  # Batches between checkpoint writes (always flushed on exit/SIGTERM)
+NUM_PROCESSES = int(os.getenv("INGEST_PROCESSES", "4"))  # Shards, one ingestion process each
 
-# Initialize Clients
-print("🔄 Initializing Clients...")
-pc = Pinecone(api_key=PINECONE_API_KEY)
-genai.configure(api_key=GOOGLE_API_KEY)
+# Set per worker process by run_shard()
+shard_rank = 0
+index = None
+FAIL_FH = None
 
-# Check Index
-try:
-    existing_indexes = [i.name for i in pc.list_indexes()]
-    if INDEX_NAME not in existing_indexes:
-        print(f"⚠️ Index {INDEX_NAME} not found. Creating...")
-        pc.create_index(
-            name=INDEX_NAME,
-            dimension=768,
-            metric="dotproduct",
-            spec=ServerlessSpec(cloud="aws", region="us-east-1")
-        )
-except Exception as e:
-    print(f"❌ Failed to verify/create index: {e}")
-    exit(1)
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        try:
+            return orjson.loads(f.read())
+        except: return None
 
-index = pc.Index(INDEX_NAME)
+def save_checkpoint(last_processed_id, offset):
+    # Write-then-rename so a crash mid-write can never leave a corrupt checkpoint behind
+    checkpoint_file = CHECKPOINT_PATTERN.format(rank=shard_rank)
+    tmp_file = checkpoint_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(orjson.dumps({
+            "lastId": str(last_processed_id),
+            "offset": offset,
+            "rank": shard_rank,
+            "shards": NUM_PROCESSES,
+            "timestamp": time.time()
+        }))
+    os.replace(tmp_file, checkpoint_file)
 
-# Load Checkpoint
-last_id = None
-if os.path.exists(CHECKPOINT_FILE):
-    with open(CHECKPOINT_FILE, 'r') as f:
-        try:
-            ckpt = json.load(f)
-            last_id = ckpt.get("lastId")
-            print(f"🔄 Resuming from ID: {last_id}")
-        except: pass
+# Reentrant: the signal handler may fire on the main thread while it is already flushing
+checkpoint_lock = threading.RLock()
+pending_checkpoint = None
+batches_since_checkpoint = 0
 
-def save_checkpoint(last_processed_id):
-    with open(CHECKPOINT_FILE, 'w') as f:
-        json.dump({"lastId": str(last_processed_id), "timestamp": time.time()}, f)
+def advance_checkpoint(last_processed_id, offset, batches):
+    """
+    Records progress, but only writes it to disk every CHECKPOINT_EVERY batches.
+    """
+    global pending_checkpoint, batches_since_checkpoint
+    with checkpoint_lock:
+        pending_checkpoint = (last_processed_id, offset)
+        batches_since_checkpoint += batches
+        if batches_since_checkpoint >= CHECKPOINT_EVERY:
+            save_checkpoint(*pending_checkpoint)
+            batches_since_checkpoint = 0
+
+def flush_checkpoint():
+    global batches_since_checkpoint
+    with checkpoint_lock:
+        if pending_checkpoint is not None and batches_since_checkpoint:
+            save_checkpoint(*pending_checkpoint)
+            batches_since_checkpoint = 0
+
+def handle_termination(signum, frame):
+    flush_checkpoint()
+    print(f"🛑 [shard {shard_rank}] Received signal {signum}. Checkpoint flushed, exiting.")
+    # Stage threads are blocked on queues; skip the interpreter's thread joins
+    os._exit(128 + signum)
 
 def log_failure(item_id, title, error):
     entry = {"id": item_id, "title": title, "error": str(error)}
-    existing = []
-    if os.path.exists(FAILED_LOG_FILE):
-        try:
-            with open(FAILED_LOG_FILE, 'r') as f:
-                existing = json.load(f)
-        except: pass
-    existing.append(entry)
-    with open(FAILED_LOG_FILE, 'w') as f:
-        json.dump(existing, f)
+    FAIL_FH.write(orjson.dumps(entry).decode() + "\n")
 
 
-# Load Data using Streaming (ijson)
-print(f"📖 Streaming data from {DATA_FILE}...")
 # Use ijson to avoid loading 1GB+ into RAM which causes OOM/stalls
-import ijson
+try:
+    import ijson.backends.yajl2_c as ijson  # C parser, much faster than the pure-Python backend
+except ImportError:
+    import ijson
+
+# Prefix that re-opens the movies array when parsing from a checkpointed byte offset
+RESUME_PREFIX = b'{"data": {"movies": ['
+
+
+class LineReader:
+    """
+    Hands ijson one line per read() so tell() lands right after the last movie yielded.
+    Relies on the exporter (scripts/create-kg-from-csv.js) writing one movie per line.
+    An optional prefix is replayed first, so a stream seek()ed into the array still parses.
+    """
+    def __init__(self, f, prefix=b""):
+        self.f = f
+        self.prefix = prefix
+
+    def read(self, size=-1):
+        if size == 0:
+            return b""
+        if self.prefix:
+            data, self.prefix = self.prefix, b""
+            return data
+        return self.f.readline()
+
+    def tell(self):
+        return self.f.tell()
 
-# Processing Loop
-# Processing Loop - Optimized with Parallelism
+# Processing Loop - Pipelined: ijson producer -> async embed stage -> upsert worker
+import asyncio
 import concurrent.futures
+from queue import Empty, Full, Queue
+import aiohttp
+
+EMBED_CONCURRENCY = 50  # In-flight embed requests; adjust based on rate limits
+QUEUE_SIZE = 16  # Batches buffered between stages (vectors are compact float32 arrays)
+MAX_BATCHES_IN_FLIGHT = 64  # Hard cap on batches anywhere between reader and finished upsert, per shard
+STOP_POLL_SECONDS = 0.5  # How often a blocked stage checks whether another stage has failed
+EMBED_REQUESTS_PER_MINUTE = 1500  # Published Gemini quota for text-embedding-004, shared by all shards
+
+# Persistent pool hosting the long-running stages (async embed loop + upsert worker)
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+# Single thread that owns the sqlite embed cache, so cache reads/writes (and lock waits) stay off the event loop
+CACHE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1)
 
-BATCH_SIZE = 100
-MAX_WORKERS = 15  # Adjust based on rate limits
+embed_queue = Queue(maxsize=QUEUE_SIZE)
+upsert_queue = Queue(maxsize=QUEUE_SIZE)
+# Taken by the reader per batch, given back by the upsert worker once the batch is done, so memory
+# stays bounded by MAX_BATCHES_IN_FLIGHT batches however the stage speeds drift apart
+batch_budget = threading.BoundedSemaphore(MAX_BATCHES_IN_FLIGHT)
+# Set by whichever stage fails, so the others stop waiting on queues it will never serve
+stop_event = threading.Event()
 
-batch_buffer = []
 processed_count = 0
 failed_count = 0
-skip_mode = True if last_id else False
 
-print(f"🚀 Starting Optimized Ingestion Loop (Workers: {MAX_WORKERS})...")
 
-def generate_embedding(data_item):
+class PipelineStopped(Exception):
+    """Raised in a stage that was blocked when another stage failed."""
+
+
+def put_or_stop(q, item):
+    while not stop_event.is_set():
+        try:
+            q.put(item, timeout=STOP_POLL_SECONDS)
+            return
+        except Full:
+            pass
+    raise PipelineStopped()
+
+
+def get_or_stop(q):
+    while not stop_event.is_set():
+        try:
+            return q.get(timeout=STOP_POLL_SECONDS)
+        except Empty:
+            pass
+    raise PipelineStopped()
+
+
+def run_stage(stage, *args):
+    """Runs a pipeline stage on the executor; if it fails, the other stages are told to stop."""
+    try:
+        return stage(*args)
+    except BaseException:
+        stop_event.set()
+        raise
+
+class RateLimiter:
+    """
+    Token bucket that paces requests before they are sent, instead of reacting to 429s.
+    Holds about one second of burst so requests are spread evenly across the minute.
     """
-    Function to be run in parallel.
-    Returns (item, vector_object) or (item, None) if failed.
+    def __init__(self, rate, period=60.0):
+        self.fill_rate = rate / period
+        self.capacity = max(1.0, self.fill_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self.tokens) / self.fill_rate)
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+limiter = RateLimiter(EMBED_REQUESTS_PER_MINUTE / NUM_PROCESSES, 60)
+
+
+class AdaptiveBackoff:
+    """
+    One pause shared by every embed request. A 429 pushes the common deadline out, by the
+    server's Retry-After when given and exponentially otherwise; a success resets the streak.
+    Only touched from the embed stage's event loop, so it needs no lock.
     """
-    movie, text = data_item
+    def __init__(self, base=2.0, maximum=60.0):
+        self.base = base
+        self.maximum = maximum
+        self.deadline = 0.0
+        self.strikes = 0
+
+    def penalize(self, seconds=None):
+        now = time.monotonic()
+        if seconds is None:
+            if now < self.deadline:
+                return  # Already paused; 429s from requests sent before the pause don't escalate it
+            seconds = min(self.maximum, self.base * 2 ** self.strikes)
+            self.strikes += 1
+        self.deadline = max(self.deadline, now + seconds)
+
+    def reset(self):
+        self.strikes = 0
+
+    async def wait(self):
+        delay = self.deadline - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.deadline - time.monotonic()
+
+
+backoff = AdaptiveBackoff()
+
+
+def retry_after_seconds(error):
+    """
+    Seconds from a 429's Retry-After header, or None if absent/unparseable.
+    """
+    headers = getattr(error, "headers", None)
+    try:
+        return float(headers.get("Retry-After")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+# Opened and used only on CACHE_EXECUTOR's thread (sqlite connections are thread-bound)
+embed_cache = None
+# Part of every cache key, so switching model or task type never serves stale vectors
+EMBED_CACHE_KEY_PREFIX = f"{EMBEDDING_MODEL}\0{EMBED_TASK_TYPE}\0".encode()
+
+def open_embed_cache():
+    conn = sqlite3.connect(EMBED_CACHE_FILE, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")  # Lets the shard processes read while one writes
+    conn.execute("CREATE TABLE IF NOT EXISTS embed_cache (hash BLOB PRIMARY KEY, vec BLOB)")
+    return conn
+
+def text_hash(text):
+    return hashlib.blake2b(EMBED_CACHE_KEY_PREFIX + text.encode(), digest_size=16).digest()
+
+async def in_cache_thread(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(CACHE_EXECUTOR, fn, *args)
+
+def cache_lookup(hashes):
+    placeholders = ",".join("?" * len(hashes))
+    rows = embed_cache.execute(f"SELECT hash, vec FROM embed_cache WHERE hash IN ({placeholders})", hashes)
+    return {h: np.frombuffer(vec, dtype=np.float32) for h, vec in rows}
+
+def cache_store(hashes, embeddings):
+    with embed_cache:
+        embed_cache.executemany(
+            "INSERT OR IGNORE INTO embed_cache (hash, vec) VALUES (?, ?)",
+            [(h, e.tobytes()) for h, e in zip(hashes, embeddings)]
+        )
+
+
+async def generate_embedding(session, work_items):
+    """
+    Returns a list of vectors aligned with work_items, or None if failed.
+    Texts already in the local cache (resumes, failed-item retries) skip the API entirely.
+    """
+    hashes = [text_hash(text) for _, text, _ in work_items]
+    vectors = await in_cache_thread(cache_lookup, hashes)
+    missing = [(h, text) for h, (_, text, _) in zip(hashes, work_items) if h not in vectors]
+    if missing:
+        embeddings = await request_embeddings(session, [text for _, text in missing])
+        if embeddings is None:
+            return None
+        await in_cache_thread(cache_store, [h for h, _ in missing], embeddings)
+        vectors.update(zip([h for h, _ in missing], embeddings))
+    return [vectors[h] for h in hashes]
+
+
+async def request_embeddings(session, texts):
+    """
+    Embeds texts with a single batchEmbedContents request.
+    Returns a list of vectors aligned with texts, or None if failed.
+    """
+    payload = {"requests": [
+        {"model": EMBEDDING_MODEL, "content": {"parts": [{"text": text}]}, "taskType": EMBED_TASK_TYPE}
+        for text in texts
+    ]}
     retries = 3
     while retries > 0:
         try:
-            result = genai.embed_content(
-                model=EMBEDDING_MODEL,
-                content=text,
-                task_type="retrieval_document"
-            )
-            embedding = result['embedding']
-            
-            metadata = {
-                "title": movie.get("title", "Unknown")[:1000],
-                "year": movie.get("release_date", "")[:4] if movie.get("release_date") else "",
-                "genres": str(movie.get("genres", ""))[:1000],
-                "poster_path": movie.get("poster_path", "") or "",
-                "overview": movie.get("overview", "")[:1000], # Limit size for Pinecone metadata limits (40KB total record)
-                "vote_average": float(movie.get("vote_average", 0)),
-                "popularity": float(movie.get("popularity", 0))
-            }
-            
-            return movie, {
-                "id": str(movie.get("id")),
-                "values": embedding,
-                "metadata": metadata
-            }
+            await backoff.wait()
+            async with limiter:
+                async with session.post(EMBED_URL, params={"key": GOOGLE_API_KEY}, json=payload) as resp:
+                    resp.raise_for_status()
+                    result = orjson.loads(await resp.read())
+            backoff.reset()
+            # float32 arrays are ~3KB per vector vs ~25KB as a list of Python floats
+            return [np.asarray(e["values"], dtype=np.float32) for e in result["embeddings"]]
         except Exception as e:
-            if "429" in str(e):
-                time.sleep(2 * (4 - retries)) # Exponential-ish backoff
+            if isinstance(e, aiohttp.ClientResponseError) and e.status == 429:
+                # Pause every request, not just this one; the next attempt waits in backoff.wait()
+                backoff.penalize(retry_after_seconds(e))
             else:
                 # print(f"⚠️ Error: {e}") 
                 pass
             retries -= 1
             
-    return movie, None
+    return None
+
+
+def build_work_item(movie):
+    """
+    Builds one (movie_id, text, metadata) work item. Runs once per movie on the producer thread.
+    """
+    get = movie.get
+    title = get("title", "Unknown")
+    overview = get("overview", "")
+    # Handle genres
+    genres = get("genres", [])
+    if isinstance(genres, list):
+        genres = ", ".join([str(g.get("name", "")) for g in genres if isinstance(g, dict)])
+    else:
+        genres = str(genres)
+    release_date = get("release_date")
+
+    metadata = {
+        "title": title[:1000],  # Limit size for Pinecone metadata limits (40KB total record)
+        "year": release_date[:4] if release_date else "",
+        "genres": genres[:1000],
+        "poster_path": get("poster_path", "") or "",
+        "overview": overview[:1000],
+        "vote_average": float(get("vote_average", 0)),
+        "popularity": float(get("popularity", 0))
+    }
 
+    # Kept as an f-string on purpose: on CPython 3.11 it compiles to a single BUILD_STRING and
+    # measured faster than both "%"-formatting and "".join of a tuple
+    text = f"Title: {title}. Overview: {overview}. Genres: {genres}"
+    return str(get("id")), text, metadata
 
-def process_batch(batch_items, index_obj):
+
+def prepare_batch(batch_items):
     """
-    Takes a list of raw movie objects, generates embeddings in parallel, and upserts.
+    Turns raw movie objects into (movie_id, text, metadata) work items for the embed stage.
+    Metadata is built here, once, so the embed stage only has to attach the vectors.
+    Records that can't be built (e.g. a null title or overview) come back as
+    (movie_id, title, error) failures instead of taking down the producer.
     """
-    # Prepare data for worker
     work_items = []
+    failed_movies = []
     for movie in batch_items:
-        title = movie.get("title", "Unknown")
-        overview = movie.get("overview", "")
-        # Handle genres
-        genres_list = movie.get("genres", [])
-        if isinstance(genres_list, list):
-            genres = ", ".join([str(g.get("name", "")) for g in genres_list if isinstance(g, dict)])
-        else:
-            genres = str(genres_list)
-        
-        # Mutate movie object temporarily to store clean genres for metadata (hacky but works)
-        movie['genres'] = genres
-        
-        text = f"Title: {title}. Overview: {overview}. Genres: {genres}"
-        work_items.append((movie, text))
+        try:
+            work_items.append(build_work_item(movie))
+        except Exception as e:
+            failed_movies.append((str(movie.get("id")), movie.get("title"), f"Invalid movie record: {e}"))
+    return work_items, failed_movies
+
 
+async def embed_batch(session, batch):
+    seq, work_items, failed_movies, last_id_in_batch, offset = batch
+    if not work_items:
+        return seq, [], failed_movies, True, last_id_in_batch, offset
     vectors_to_upsert = []
-    failed_in_batch = 0
-    
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        results = executor.map(generate_embedding, work_items)
-        
-    for movie, vector in results:
-        if vector:
-            vectors_to_upsert.append(vector)
-        else:
-            failed_in_batch += 1
-            log_failure(movie.get('id'), movie.get('title'), "Embedding generation failed after retries")
+    try:
+        embeddings = await generate_embedding(session, work_items)
+        if embeddings:
+            for (movie_id, _, metadata), embedding in zip(work_items, embeddings):
+                vectors_to_upsert.append({"id": movie_id, "values": embedding, "metadata": metadata})
+    except Exception as e:
+        print(f"⚠️ Batch {seq} embed error: {e}")
+        vectors_to_upsert = []
+
+    embedded = bool(vectors_to_upsert)
+    if not embedded:
+        failed_movies = failed_movies + [
+            (movie_id, metadata["title"], "Embedding generation failed after retries")
+            for movie_id, _, metadata in work_items
+        ]
+    return seq, vectors_to_upsert, failed_movies, embedded, last_id_in_batch, offset
+
+
+async def embed_and_forward(session, batch):
+    """
+    Embeds one batch and hands it to the upsert stage as soon as it completes, so a batch
+    stuck retrying a 429 never holds back batches that finished after it.
+    """
+    result = await embed_batch(session, batch)
+    await asyncio.to_thread(put_or_stop, upsert_queue, result)
+
+
+async def embed_stage():
+    """
+    Stage 2: embeds queued batches concurrently over one shared aiohttp session.
+    Each batch is a single request, so bounding batches in flight bounds requests in flight.
+    """
+    global embed_cache
+    embed_cache = await in_cache_thread(open_embed_cache)
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+    tasks = set()
+    async with aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=120),
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+    ) as session:
+        while True:
+            await semaphore.acquire()
+            batch = await asyncio.to_thread(get_or_stop, embed_queue)
+            if batch is None:
+                break
+            task = asyncio.create_task(embed_and_forward(session, batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: semaphore.release())
+        await asyncio.gather(*tasks)
+    await in_cache_thread(embed_cache.close)
+    put_or_stop(upsert_queue, None)
+
+
+def embed_worker():
+    # Hosts the asyncio loop on its own thread so the main thread stays the ijson producer
+    asyncio.run(embed_stage())
+
+
+def chunk_vectors(vectors):
+    """
+    Splits vectors into upsert requests capped at both UPSERT_BATCH_SIZE vectors and
+    UPSERT_BYTE_BUDGET serialized bytes, so long overviews can't push a request past 2MB.
+    Values stay float32 arrays through the queues and only become lists here, right before
+    the upsert call. Sizes are measured with stdlib json.dumps because that is what the Pinecone
+    REST client sends: ", " separators and ensure_ascii, so each non-ASCII char costs 6 bytes.
+    """
+    chunk = []
+    chunk_bytes = 0
+    for vector in vectors:
+        # Round-trip through orjson rather than .tolist(): it writes the shortest float32 repr,
+        # so the floats re-serialize as e.g. 0.1 instead of 0.10000000149011612 (~40% smaller)
+        values = orjson.loads(orjson.dumps(vector["values"], option=orjson.OPT_SERIALIZE_NUMPY))
+        vector = {**vector, "values": values}
+        size = len(json.dumps(vector)) + 2  # + the ", " separating it from the next vector
+        if chunk and (len(chunk) >= UPSERT_BATCH_SIZE or chunk_bytes + size > UPSERT_BYTE_BUDGET):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(vector)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def upsert_worker(index_obj):
+    """
+    Stage 3: drains upsert_queue into Pinecone. Also the only writer of the failure log.
+    Batches may finish out of order, so the checkpoint only advances over contiguous batches.
+    A batch whose embed or upsert failed never completes, so the checkpoint stays before it
+    and the next run retries it (the embed cache makes its already-embedded neighbours free).
+    """
+    global processed_count, failed_count
+    finished = False
+    next_seq = 0
+    completed = {}
+
+    while not finished:
+        # Block for one batch, then take whatever else is already waiting so their upserts overlap
+        items = [get_or_stop(upsert_queue)]
+        while len(items) < UPSERT_POOL_THREADS and not upsert_queue.empty():
+            items.append(upsert_queue.get_nowait())
+
+        in_flight = []
+        for item in items:
+            if item is None:
+                finished = True
+                continue
+            try:
+                # Building or submitting a request can fail synchronously too; keep it per batch
+                async_results = [index_obj.upsert(vectors=chunk, async_req=True) for chunk in chunk_vectors(item[1])]
+                in_flight.append((item, async_results, None))
+            except Exception as e:
+                in_flight.append((item, [], e))
+
+        for (seq, vectors_to_upsert, failed_movies, written, last_id_in_batch, offset), async_results, error in in_flight:
+            try:
+                if error is not None:
+                    raise error
+                # Join every request of the batch before it counts towards the checkpoint
+                [r.get() for r in async_results]
+                processed_count += len(vectors_to_upsert)
+            except Exception as e:
+                print(f"❌ Critical Batch Upsert Failed: {e}")
+                for vector in vectors_to_upsert:
+                    log_failure(vector["id"], vector["metadata"]["title"], f"Upsert failed: {e}")
+                failed_count += len(vectors_to_upsert)
+                written = False
+            for movie_id, title, reason in failed_movies:
+                log_failure(movie_id, title, reason)
+            failed_count += len(failed_movies)
+
+            if written:
+                completed[seq] = (last_id_in_batch, offset)
+            else:
+                print(f"⚠️ [shard {shard_rank}] Batch {seq} was not written. Checkpoint stays before it so the next run retries it.")
+            batch_budget.release()
+
+        if in_flight:
+            print(f"⏳ [shard {shard_rank}] Processed {processed_count} items... (Failed: {failed_count})")
 
-    if vectors_to_upsert:
+        checkpoint = None
+        advanced = 0
+        while next_seq in completed:
+            checkpoint = completed.pop(next_seq)
+            next_seq += 1
+            advanced += 1
+        if checkpoint is not None:
+            advance_checkpoint(*checkpoint, advanced)
+
+
+def enqueue_batch(seq, batch_items, offset):
+    """
+    Hands a batch to the embed stage. Blocks while the pipeline already holds
+    MAX_BATCHES_IN_FLIGHT batches, throttling the reader to the slowest stage.
+    """
+    while not batch_budget.acquire(timeout=STOP_POLL_SECONDS):
+        if stop_event.is_set():
+            raise PipelineStopped()
+    work_items, failed_movies = prepare_batch(batch_items)
+    put_or_stop(embed_queue, (seq, work_items, failed_movies, batch_items[-1].get("id"), offset))
+
+
+def find_resume_offset(f, last_id):
+    """
+    Byte offset just past the movie with last_id, or None if it isn't in the file.
+    Matches the raw bytes of each line (one movie per line) and only JSON-decodes candidate
+    lines, instead of running every already-ingested movie through ijson.
+    """
+    needles = (b'"id":"%s"' % last_id.encode(), b'"id":%s,' % last_id.encode())
+    for line in iter(f.readline, b""):
+        if not any(needle in line for needle in needles):
+            continue
         try:
-            index_obj.upsert(vectors=vectors_to_upsert)
-            # Checkpoint with the ID of the LAST successfully upserted item in this batch
-            # Ideally we checkpoint the last item of the input batch, assuming monotonic processing
-            last_movie_in_batch = batch_items[-1]
-            save_checkpoint(last_movie_in_batch.get("id"))
-            # print(f"✅ Upserted batch of {len(vectors_to_upsert)}. Last ID: {last_movie_in_batch.get('id')}")
-        except Exception as e:
-            print(f"❌ Critical Batch Upsert Failed: {e}")
-            # Consider dumping this batch to a retry file?
-            
-    return len(vectors_to_upsert), failed_in_batch
-
-
-with open(DATA_FILE, 'rb') as f:
-    movies_generator = ijson.items(f, 'data.movies.item')
-    
-    current_batch = []
-    
-    for movie in movies_generator:
-        movie_id = str(movie.get("id"))
-    
-        # Skip logic
-        if skip_mode:
-            if movie_id == str(last_id):
-                skip_mode = False
-                print("✅ Found checkpoint. Resuming processing...")
+            movie = orjson.loads(line.rstrip().rstrip(b","))
+        except orjson.JSONDecodeError:
             continue
-            
-        current_batch.append(movie)
-        
-        if len(current_batch) >= BATCH_SIZE:
-             success, failed = process_batch(current_batch, index)
-             processed_count += success
-             failed_count += failed
-             current_batch = []
-             print(f"⏳ Processed {processed_count} items... (Failed: {failed_count})")
-
-    # Flush final
-    if current_batch:
-        success, failed = process_batch(current_batch, index)
-        processed_count += success
-        failed_count += failed
-        print("✅ Final batch upserted.")
-
-print(f"🎉 Ingestion Complete. Processed: {processed_count}, Failed: {failed_count}")
+        if isinstance(movie, dict) and str(movie.get("id")) == last_id:
+            return f.tell()
+    return None
+
+
+def at_end_of_movies(f):
+    """
+    True if a resume offset sits at or past the end of the movies array (closing bracket or EOF),
+    i.e. the previous run already got through every movie and there is nothing left to parse.
+    """
+    pos = f.tell()
+    line = f.readline().lstrip()
+    f.seek(pos)
+    return not line.startswith(b"{")
+
+
+def in_shard(movie_id, rank):
+    # crc32 rather than hash(): str hashes are salted per process, so shards would overlap
+    return zlib.crc32(movie_id.encode()) % NUM_PROCESSES == rank
+
+
+def stream_movies(rank, last_id, last_offset):
+    """
+    Stage 1 (main thread): streams movies with ijson and feeds embed_queue in batches.
+    """
+    with open(DATA_FILE, 'rb') as f:
+        if last_offset is None and last_id:
+            # Older checkpoints only have an ID; turn it into an offset with a raw line scan
+            last_offset = find_resume_offset(f, str(last_id))
+            if last_offset is None:
+                print(f"⚠️ [shard {rank}] Checkpoint ID {last_id} not found. Starting from the top...")
+                f.seek(0)
+        if last_offset is not None:
+            # Seek straight past everything already ingested instead of re-parsing it
+            f.seek(last_offset)
+            reader = LineReader(f, prefix=RESUME_PREFIX)
+            print(f"✅ [shard {rank}] Seeked to checkpoint offset {last_offset}. Resuming processing...")
+        else:
+            reader = LineReader(f)
+        if last_offset is not None and at_end_of_movies(f):
+            print(f"✅ [shard {rank}] Checkpoint is already past the last movie. Nothing left to ingest.")
+            movies_generator = ()
+        else:
+            # use_float: yield plain floats instead of Decimals for vote_average/popularity etc.
+            movies_generator = ijson.items(reader, 'data.movies.item', use_float=True)
+
+        current_batch = []
+        batch_seq = 0
+        # Offset just past the last appended movie; reader.tell() after the loop is EOF,
+        # which isn't a valid place to replay RESUME_PREFIX from
+        batch_offset = None
+
+        for movie in movies_generator:
+            movie_id = str(movie.get("id"))
+
+            if not in_shard(movie_id, rank):
+                continue
+
+            current_batch.append(movie)
+            batch_offset = reader.tell()
+
+            if len(current_batch) >= EMBED_BATCH_SIZE:
+                enqueue_batch(batch_seq, current_batch, batch_offset)
+                batch_seq += 1
+                current_batch = []
+
+        # Flush final
+        if current_batch:
+            enqueue_batch(batch_seq, current_batch, batch_offset)
+
+
+def run_shard(rank, last_id, last_offset):
+    """
+    Worker process entry point: streams the whole file but only ingests movies whose id
+    hashes to this rank, with its own Pinecone client, pipeline threads and checkpoint.
+    """
+    global shard_rank, index, FAIL_FH
+    shard_rank = rank
+    index = Pinecone(api_key=PINECONE_API_KEY).Index(INDEX_NAME, pool_threads=UPSERT_POOL_THREADS)
+    # Append-only JSON Lines log shared by all shards; short O_APPEND line writes don't interleave
+    FAIL_FH = open(FAILED_LOG_FILE, 'a', buffering=1)
+
+    signal.signal(signal.SIGTERM, handle_termination)
+    signal.signal(signal.SIGINT, handle_termination)
+
+    embed_future = EXECUTOR.submit(run_stage, embed_worker)
+    upsert_future = EXECUTOR.submit(run_stage, upsert_worker, index)
+
+    error = None
+    try:
+        stream_movies(rank, last_id, last_offset)
+    except PipelineStopped:
+        pass
+    except BaseException as e:
+        stop_event.set()
+        error = e
+    try:
+        # Sentinel: the embed stage forwards it to the upsert worker once drained
+        put_or_stop(embed_queue, None)
+    except PipelineStopped:
+        pass
+
+    # Wait for both stages either way; report the stage that failed, not the ones it stopped
+    for future in (embed_future, upsert_future):
+        try:
+            future.result()
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            error = error or e
+    EXECUTOR.shutdown()
+    CACHE_EXECUTOR.shutdown()
+    flush_checkpoint()
+    FAIL_FH.close()
+
+    if error is not None:
+        print(f"❌ [shard {rank}] Pipeline stopped: {error!r}")
+        raise error
+
+    return processed_count, failed_count
+
+
+def resume_points():
+    """
+    (last_id, offset) per shard. A shard without its own checkpoint starts from the legacy
+    single-process checkpoint if there is one (everything before it is ingested), else from the top.
+    """
+    legacy = load_checkpoint(LEGACY_CHECKPOINT_FILE)
+    points = []
+    for rank in range(NUM_PROCESSES):
+        ckpt = load_checkpoint(CHECKPOINT_PATTERN.format(rank=rank)) or legacy
+        points.append((ckpt.get("lastId"), ckpt.get("offset")) if ckpt else (None, None))
+    return points
+
+
+def handle_parent_termination(signum, frame):
+    # Unwinds through the Pool context manager, which terminates (SIGTERMs) the shards
+    raise SystemExit(128 + signum)
+
+
+def main():
+    print(f"DEBUG: Loaded env from {env_path}")
+    print(f"DEBUG: Pinecone Key: {PINECONE_API_KEY[:10]}... (Length: {len(PINECONE_API_KEY)})" if PINECONE_API_KEY else "DEBUG: Pinecone Key: None")
+
+    if not PINECONE_API_KEY:
+        print("❌ Missing PINECONE_API_KEY")
+        exit(1)
+    if not GOOGLE_API_KEY:
+        print("❌ Missing GOOGLE_API_KEY")
+        exit(1)
+
+    # Initialize Clients
+    print("🔄 Initializing Clients...")
+    pc = Pinecone(api_key=PINECONE_API_KEY)
+
+    # Check Index
+    try:
+        existing_indexes = [i.name for i in pc.list_indexes()]
+        if INDEX_NAME not in existing_indexes:
+            print(f"⚠️ Index {INDEX_NAME} not found. Creating...")
+            pc.create_index(
+                name=INDEX_NAME,
+                dimension=768,
+                metric="dotproduct",
+                spec=ServerlessSpec(cloud="aws", region="us-east-1")
+            )
+    except Exception as e:
+        print(f"❌ Failed to verify/create index: {e}")
+        exit(1)
+
+    # Shard checkpoints are only meaningful for the shard count that wrote them
+    for path in glob.glob(CHECKPOINT_PATTERN.format(rank="*")):
+        ckpt = load_checkpoint(path)
+        if ckpt and ckpt.get("shards") != NUM_PROCESSES:
+            print(f"❌ {path} was written with {ckpt.get('shards')} processes. "
+                  f"Re-run with INGEST_PROCESSES={ckpt.get('shards')} or delete the shard checkpoints.")
+            exit(1)
+
+    points = resume_points()
+    for rank, (last_id, last_offset) in enumerate(points):
+        if last_id:
+            print(f"🔄 [shard {rank}] Resuming from ID: {last_id}")
+
+    print(f"📖 Streaming data from {DATA_FILE}...")
+    print(f"🚀 Starting Pipelined Ingestion Loop (Processes: {NUM_PROCESSES}, Embed Concurrency: {EMBED_CONCURRENCY})...")
+
+    if NUM_PROCESSES == 1:
+        results = [run_shard(0, *points[0])]
+    else:
+        signal.signal(signal.SIGTERM, handle_parent_termination)
+        with multiprocessing.Pool(NUM_PROCESSES, maxtasksperchild=1) as pool:
+            results = pool.starmap(run_shard, [(rank, *points[rank]) for rank in range(NUM_PROCESSES)])
+            # Let the shards exit on their own; leaving the with block terminate()s (SIGTERMs)
+            # them, which is only meant for the error and signal paths
+            pool.close()
+            pool.join()
+
+    processed = sum(p for p, _ in results)
+    failed = sum(f for _, f in results)
+    print(f"🎉 Ingestion Complete. Processed: {processed}, Failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()